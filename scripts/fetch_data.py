@@ -1,14 +1,66 @@
 # scripts/fetch_data.py
 import os
-import json
+import asyncio
+import aiohttp
+import orjson
 import pandas as pd
-from datetime import datetime, timedelta
+import requests
+from datetime import datetime
+from pathlib import Path
 from garminconnect import Garmin
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Maximum number of activity detail requests in flight at once
+DETAIL_CONCURRENCY = 4
+
+# Size of the shared connection pool for Garmin API requests
+POOL_SIZE = 32
+
+# Number of activities requested per page of the activity list
+PAGE_SIZE = 100
+
+# Activity types shown on the dashboard
+ACTIVITY_TYPES = ['running', 'cycling', 'lap_swimming', 'open_water_swimming']
+
+# Columns of the saved activities table
+ACTIVITY_COLUMNS = [
+    'id', 'date', 'type', 'name', 'distance', 'duration', 'calories',
+    'avg_heart_rate', 'max_heart_rate', 'avg_speed', 'max_speed',
+    'elevation_gain', 'start_lat', 'start_lon'
+]
+
+# Garmin activity summary fields copied into the saved table, by column name
+SUMMARY_FIELDS = {
+    'activityId': 'id',
+    'activityName': 'name',
+    'distance': 'distance',  # in meters
+    'duration': 'duration',  # in seconds
+    'calories': 'calories',
+    'averageHR': 'avg_heart_rate',
+    'maxHR': 'max_heart_rate',
+    'averageSpeed': 'avg_speed',
+    'maxSpeed': 'max_speed',
+    'elevationGain': 'elevation_gain',
+    'startLatitude': 'start_lat',
+    'startLongitude': 'start_lon'
+}
+
+# Where Garmin session tokens are cached between runs
+TOKENSTORE = os.getenv('GARMINTOKENS', '~/.garminconnect')
+
+def create_http_session():
+    """Create a pooled keep-alive session that retries throttled requests"""
+    session = requests.Session()
+    session.headers['Connection'] = 'keep-alive'
+    retries = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 502, 503], raise_on_status=False)
+    session.mount('https://', HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retries))
+    return session
+
 def connect_to_garmin():
     """Connect to Garmin using credentials from environment variables"""
     email = os.getenv('GARMIN_EMAIL')
@@ -20,110 +72,180 @@ def connect_to_garmin():
     try:
         # Current garminconnect API - pass credentials to constructor
         client = Garmin(email, password)
-        # Call login() without parameters
-        client.login()
+        # garminconnect opens a new session, and so a new TLS connection, for every
+        # API request; hand it one shared session so connections are reused
+        session = create_http_session()
+        client.client._fresh_api_session = lambda: session
+        # Resume the session saved in TOKENSTORE; only if those tokens are missing
+        # or invalid does this do a full credential login and save fresh tokens
+        client.login(TOKENSTORE)
         logger.info("Successfully connected to Garmin Connect")
         return client
     except Exception as e:
         logger.error(f"Failed to connect to Garmin: {e}")
         raise
 
-def fetch_activities(client, days_back=365):
-    """Fetch activities from the last N days"""
-    end_date = datetime.now()
-    start_date = end_date - timedelta(days=days_back)
+async def fetch_detail(session, semaphore, activity_url, activity_id):
+    """Fetch detailed data for a single activity"""
+    async with semaphore:
+        try:
+            async with session.get(f"{activity_url}/{activity_id}") as response:
+                response.raise_for_status()
+                return activity_id, await response.json()
+        except Exception as e:
+            logger.warning(f"Could not get detailed data for activity {activity_id}: {e}")
+            return activity_id, {}
+
+async def fetch_details(client, activity_ids):
+    """Fetch detailed data for many activities concurrently"""
+    if not activity_ids:
+        return {}
+    
+    # Reuse the authenticated Garmin session headers for the raw API calls
+    activity_url = f"https://connectapi.{client.client.domain}{client.garmin_connect_activity}"
+    semaphore = asyncio.Semaphore(DETAIL_CONCURRENCY)
+    
+    async with aiohttp.ClientSession(headers=client.client.get_api_headers()) as session:
+        results = await asyncio.gather(
+            *(fetch_detail(session, semaphore, activity_url, aid) for aid in activity_ids)
+        )
+    
+    return dict(results)
+
+def list_activities(client, fetch_from, seen_ids=()):
+    """Page through the activity list, newest first, until reaching known or older activities"""
+    activities_list = []
+    start = 0
+    
+    while True:
+        page = client.get_activities(start, PAGE_SIZE)
+        new = [activity for activity in page if activity['activityId'] not in seen_ids]
+        activities_list.extend(new)
+        
+        # Stop at the first already saved activity or at the end of the list
+        if len(new) < len(page) or len(page) < PAGE_SIZE:
+            break
+        
+        # Stop once the page reaches back past the requested period
+        oldest = page[-1].get('startTimeLocal') or page[-1].get('startTimeGMT')
+        if pd.to_datetime(oldest, format='ISO8601', utc=True, errors='coerce') < fetch_from:
+            break
+        
+        start += PAGE_SIZE
+    
+    return activities_list
+
+async def fetch_activities_async(client, days_back=365, since=None, seen_ids=()):
+    """Fetch activities from the last N days as a DataFrame
     
-    activities = []
+    If since is given, only activities started after the day before it are requested.
+    Paging also stops at the first activity whose id is in seen_ids.
+    """
+    start_date = pd.Timestamp.now(tz='UTC') - pd.Timedelta(days=days_back)
+    fetch_from = start_date
+    if since is not None:
+        # Overlap by a day so timezone differences can't drop activities
+        fetch_from = max(start_date, pd.Timestamp(since, tz='UTC') - pd.Timedelta(days=1))
     
     try:
-        # Get activities list
-        activities_list = client.get_activities(0, 100)  # Adjust limit as needed
+        # Get activities list, only as far back as needed
+        activities_list = list_activities(client, fetch_from, seen_ids)
         
-        for activity in activities_list:
-            # Parse start time
-            start_time_str = activity.get('startTimeLocal') or activity.get('startTimeGMT')
-            if not start_time_str:
-                continue
-                
-            # Handle different date formats
-            try:
-                if start_time_str.endswith('Z'):
-                    activity_date = datetime.fromisoformat(start_time_str.replace('Z', '+00:00'))
-                else:
-                    activity_date = datetime.fromisoformat(start_time_str)
-            except:
-                logger.warning(f"Could not parse date: {start_time_str}")
-                continue
-            
-            # Get activity type
-            activity_type_key = activity.get('activityType', {}).get('typeKey', '').lower()
-            
-            # Filter by date and activity types
-            if (activity_date >= start_date and 
-                activity_type_key in ['running', 'cycling', 'lap_swimming', 'open_water_swimming']):
-                
-                # Get detailed activity data (optional - might fail for some activities)
-                activity_id = activity['activityId']
-                detailed_activity = {}
-                try:
-                    detailed_activity = client.get_activity(activity_id)
-                except Exception as e:
-                    logger.warning(f"Could not get detailed data for activity {activity_id}: {e}")
-                
-                # Extract relevant data with safe gets
-                activity_data = {
-                    'id': activity_id,
-                    'date': activity_date.isoformat(),
-                    'type': activity_type_key,
-                    'name': activity.get('activityName', f"{activity_type_key.title()} Activity"),
-                    'distance': activity.get('distance', 0),  # in meters
-                    'duration': activity.get('duration', 0),  # in seconds
-                    'calories': activity.get('calories', 0),
-                    'avg_heart_rate': activity.get('averageHR'),
-                    'max_heart_rate': activity.get('maxHR'),
-                    'avg_speed': activity.get('averageSpeed'),
-                    'max_speed': activity.get('maxSpeed'),
-                    'elevation_gain': activity.get('elevationGain'),
-                    'start_lat': detailed_activity.get('startLatitude'),
-                    'start_lon': detailed_activity.get('startLongitude')
-                }
-                
-                activities.append(activity_data)
-                logger.info(f"Fetched activity: {activity_data['name']} ({activity_data['type']}) - {activity_data['distance']/1000:.1f}km")
+        # Keep only the fields we use, so missing ones still exist as empty columns
+        raw = pd.DataFrame(activities_list).reindex(
+            columns=[*SUMMARY_FIELDS, 'startTimeLocal', 'startTimeGMT', 'activityType']
+        )
+        
+        # Parse start times and activity types for every activity at once;
+        # unparseable dates become NaT and never pass the filter
+        dates = pd.to_datetime(
+            raw['startTimeLocal'].fillna(raw['startTimeGMT']), format='ISO8601', utc=True, errors='coerce'
+        )
+        type_keys = raw['activityType'].astype(object).str['typeKey'].str.lower()
+        
+        # Filter by date and activity types
+        mask = dates.ge(start_date) & dates.notna() & type_keys.isin(ACTIVITY_TYPES)
+        activities = raw[mask].rename(columns=SUMMARY_FIELDS)
+        activities['date'] = dates[mask]
+        activities['type'] = type_keys[mask]
+        activities['name'] = activities['name'].fillna(activities['type'].str.title() + ' Activity')
+        activities[['distance', 'duration']] = activities[['distance', 'duration']].fillna(0)
+        
+        # The activity list already carries start coordinates; only fall back to
+        # detailed activity data for the rare activity that lacks both
+        missing = activities['start_lat'].isna() & activities['start_lon'].isna()
+        details = await fetch_details(client, activities.loc[missing, 'id'].tolist())
+        if details:
+            # Coordinates in the detail response live under summaryDTO
+            summaries = {aid: detail.get('summaryDTO', detail) for aid, detail in details.items()}
+            for column, field in (('start_lat', 'startLatitude'), ('start_lon', 'startLongitude')):
+                detail_values = activities['id'].map({aid: summary.get(field) for aid, summary in summaries.items()})
+                activities[column] = activities[column].fillna(detail_values)
         
+        activities = activities[ACTIVITY_COLUMNS].reset_index(drop=True)
+        logger.info(f"Fetched {len(activities)} activities")
         return activities
         
     except Exception as e:
+        # Re-raise so a failed fetch never advances last_update
         logger.error(f"Error fetching activities: {e}")
-        return []
+        raise
+
+def load_last_update():
+    """Return the time of the last successful fetch, or None"""
+    try:
+        last_update = orjson.loads(Path('data/last_update.json').read_bytes())['last_update']
+        return datetime.fromisoformat(last_update)
+    except (FileNotFoundError, KeyError, ValueError):
+        return None
+
+def load_saved_activities():
+    """Load previously saved activities, or None if there are none"""
+    if not os.path.exists('data/activities.parquet'):
+        return None
+    return pd.read_parquet('data/activities.parquet')
+
+def merge_activities(saved, fetched, days_back=365):
+    """Merge newly fetched activities into the saved ones, keeping the last N days"""
+    if saved is None or saved.empty:
+        activities = fetched
+    elif fetched.empty:
+        activities = saved
+    else:
+        # Refetched activities replace their saved copies
+        activities = pd.concat([saved, fetched], ignore_index=True).drop_duplicates('id', keep='last')
+    
+    start_date = pd.Timestamp.now(tz='UTC') - pd.Timedelta(days=days_back)
+    activities = activities[activities['date'] >= start_date]
+    return activities.sort_values('date', ascending=False, ignore_index=True)
 
 def save_data(activities):
-    """Save activities data to JSON file"""
+    """Save activities DataFrame to a Parquet file"""
     os.makedirs('data', exist_ok=True)
     
-    # Save raw data
-    with open('data/activities.json', 'w') as f:
-        json.dump(activities, f, indent=2, default=str)
-    
-    # Save as CSV for easier analysis
-    df = pd.DataFrame(activities)
-    if not df.empty:
-        df['date'] = pd.to_datetime(df['date'])
-        df['distance_km'] = df['distance'] / 1000
-        df['duration_minutes'] = df['duration'] / 60
-        df.to_csv('data/activities.csv', index=False)
+    # Store dates typed so readers don't have to re-parse them
+    df = activities.copy()
+    df['date'] = pd.to_datetime(df['date'], format='ISO8601', utc=True)
+    df.to_parquet('data/activities.parquet', engine='pyarrow', compression='zstd', index=False)
     
     logger.info(f"Saved {len(activities)} activities to data files")
 
 def main():
     try:
         client = connect_to_garmin()
-        activities = fetch_activities(client)
-        save_data(activities)
         
-        # Save timestamp of last update
-        with open('data/last_update.json', 'w') as f:
-            json.dump({'last_update': datetime.now().isoformat()}, f)
+        # Only fetch what changed since the last run when saved data is available
+        saved = load_saved_activities()
+        last_update = None
+        seen_ids = set()
+        if saved is not None:
+            last_update = load_last_update()
+            seen_ids = set(saved['id'])
+        fetched = asyncio.run(fetch_activities_async(client, since=last_update, seen_ids=seen_ids))
+        save_data(merge_activities(saved, fetched))
+        
+        # Save timestamp of last update, only once the data is safely saved
+        Path('data/last_update.json').write_bytes(orjson.dumps({'last_update': datetime.now().isoformat()}))
             
         logger.info("Data fetch completed successfully")
         
@@ -1,27 +1,38 @@
 # scripts/process_data.py
-import json
+import orjson
 import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
+from pathlib import Path
 import os
 
+# Known activity types, pre-encoded so groupbys work on compact category codes
+ACTIVITY_TYPE_DTYPE = pd.CategoricalDtype(categories=['cycling', 'running', 'lap_swimming', 'open_water_swimming'])
+
 def load_activities():
-    """Load activities from JSON file"""
-    try:
-        with open('data/activities.json', 'r') as f:
-            activities = json.load(f)
-        return pd.DataFrame(activities)
-    except FileNotFoundError:
-        print("No activities data found")
-        return pd.DataFrame()
+    """Load activities from the Parquet file, falling back to legacy JSON"""
+    if os.path.exists('data/activities.parquet'):
+        df = pd.read_parquet('data/activities.parquet', dtype_backend='pyarrow')
+    else:
+        try:
+            df = pd.DataFrame(orjson.loads(Path('data/activities.json').read_bytes()))
+        except FileNotFoundError:
+            print("No activities data found")
+            return pd.DataFrame()
+        df = df.convert_dtypes(dtype_backend='pyarrow')
+    
+    if not df.empty:
+        # Parse dates (a no-op for Parquet) and derive units once here rather than in every aggregation
+        df['date'] = pd.to_datetime(df['date'], format='ISO8601', utc=True)
+        df['distance_km'] = df['distance'] / 1000
+        df['type'] = df['type'].astype(ACTIVITY_TYPE_DTYPE)
+    return df
 
 def calculate_summary_stats(df):
     """Calculate summary statistics by activity type"""
     if df.empty:
         return {}
     
-    df['date'] = pd.to_datetime(df['date'])
-    df['distance_km'] = df['distance'] / 1000
     df['duration_hours'] = df['duration'] / 3600
     
     stats = {}
@@ -33,17 +44,15 @@ def calculate_summary_stats(df):
     stats['total_calories'] = df['calories'].sum()
     
     # By activity type
-    stats['by_type'] = {}
-    for activity_type in df['type'].unique():
-        type_df = df[df['type'] == activity_type]
-        stats['by_type'][activity_type] = {
-            'count': len(type_df),
-            'total_distance_km': type_df['distance_km'].sum(),
-            'avg_distance_km': type_df['distance_km'].mean(),
-            'total_duration_hours': type_df['duration_hours'].sum(),
-            'avg_duration_hours': type_df['duration_hours'].mean(),
-            'total_calories': type_df['calories'].sum()
-        }
+    by_type = df.groupby('type', sort=False, observed=True).agg(
+        count=('id', 'size'),
+        total_distance_km=('distance_km', 'sum'),
+        avg_distance_km=('distance_km', 'mean'),
+        total_duration_hours=('duration_hours', 'sum'),
+        avg_duration_hours=('duration_hours', 'mean'),
+        total_calories=('calories', 'sum')
+    )
+    stats['by_type'] = by_type.to_dict('index')
     
     return stats
 
@@ -52,34 +61,25 @@ def create_monthly_trends(df):
     if df.empty:
         return []
     
-    df['date'] = pd.to_datetime(df['date'])
-    df['month'] = df['date'].dt.to_period('M')
-    df['distance_km'] = df['distance'] / 1000
+    month_period = df['date'].dt.tz_localize(None).dt.to_period('M').rename('month')
+    grouped = df.groupby([month_period, 'type'], observed=True).agg(
+        count=('id', 'size'),
+        distance_km=('distance_km', 'sum')
+    )
     
     monthly_data = []
     
-    for month in df['month'].unique():
-        month_df = df[df['month'] == month]
+    # Groups come out sorted by month
+    for month, month_df in grouped.groupby(level='month'):
+        month_df = month_df.droplevel('month')
         
-        month_stats = {
+        monthly_data.append({
             'month': str(month),
-            'total_activities': len(month_df),
+            'total_activities': int(month_df['count'].sum()),
             'total_distance_km': month_df['distance_km'].sum(),
-            'by_type': {}
-        }
-        
-        # Break down by activity type
-        for activity_type in month_df['type'].unique():
-            type_df = month_df[month_df['type'] == activity_type]
-            month_stats['by_type'][activity_type] = {
-                'count': len(type_df),
-                'distance_km': type_df['distance_km'].sum()
-            }
-        
-        monthly_data.append(month_stats)
+            'by_type': month_df.to_dict('index')
+        })
     
-    # Sort by month
-    monthly_data.sort(key=lambda x: x['month'])
     return monthly_data
 
 def create_weekly_trends(df):
@@ -87,54 +87,53 @@ def create_weekly_trends(df):
     if df.empty:
         return []
     
-    df['date'] = pd.to_datetime(df['date'])
-    df['week'] = df['date'].dt.to_period('W')
-    df['distance_km'] = df['distance'] / 1000
+    week_period = df['date'].dt.tz_localize(None).dt.to_period('W').rename('week')
+    grouped = df.groupby([week_period, 'type'], observed=True).agg(
+        count=('id', 'size'),
+        distance_km=('distance_km', 'sum')
+    )
     
     weekly_data = []
     
-    for week in df['week'].unique():
-        week_df = df[df['week'] == week]
+    # Groups come out sorted by week; only the last 12 weeks are needed
+    weeks = grouped.index.get_level_values('week').unique()[-12:]
+    for week, week_df in grouped.loc[weeks].groupby(level='week'):
+        week_df = week_df.droplevel('week')
         
-        weekly_stats = {
+        weekly_data.append({
             'week': str(week),
             'week_start': week.start_time.isoformat(),
             'total_distance_km': week_df['distance_km'].sum(),
-            'activities': len(week_df),
-            'by_type': {}
-        }
-        
-        # Break down by activity type
-        for activity_type in week_df['type'].unique():
-            type_df = week_df[week_df['type'] == activity_type]
-            weekly_stats['by_type'][activity_type] = type_df['distance_km'].sum()
-        
-        weekly_data.append(weekly_stats)
+            'activities': int(week_df['count'].sum()),
+            'by_type': week_df['distance_km'].to_dict()
+        })
     
-    # Sort by week and take last 12 weeks
-    weekly_data.sort(key=lambda x: x['week'])
-    return weekly_data[-12:]
+    return weekly_data
 
 def create_recent_activities(df, limit=10):
     """Get recent activities for display"""
     if df.empty:
         return []
     
-    df['date'] = pd.to_datetime(df['date'])
-    df['distance_km'] = df['distance'] / 1000
-    df['duration_minutes'] = df['duration'] / 60
-    
-    recent = df.nlargest(limit, 'date')
+    # Format the few selected rows column-wise before building the dicts
+    recent = df.nlargest(limit, 'date').assign(
+        date=lambda d: d['date'].dt.strftime('%Y-%m-%d'),
+        distance_km=lambda d: d['distance_km'].round(2),
+        duration_minutes=lambda d: (d['duration'] / 60).round(1),
+        calories=lambda d: (
+            np.trunc(d['calories'].astype(float)).astype('Int64').astype(object).where(d['calories'].notna(), None)
+        )
+    )
     
     activities = []
-    for _, row in recent.iterrows():
+    for row in recent.itertuples(index=False):
         activities.append({
-            'date': row['date'].strftime('%Y-%m-%d'),
-            'name': row['name'],
-            'type': row['type'],
-            'distance_km': round(row['distance_km'], 2),
-            'duration_minutes': round(row['duration_minutes'], 1),
-            'calories': int(row['calories']) if pd.notna(row['calories']) else None
+            'date': row.date,
+            'name': row.name,
+            'type': row.type,
+            'distance_km': row.distance_km,
+            'duration_minutes': row.duration_minutes,
+            'calories': row.calories
         })
     
     return activities
@@ -158,8 +157,9 @@ def save_dashboard_data(dashboard_data):
     os.makedirs('docs', exist_ok=True)
     
     # Save main dashboard data
-    with open('docs/dashboard_data.json', 'w') as f:
-        json.dump(dashboard_data, f, indent=2, default=str)
+    Path('docs/dashboard_data.json').write_bytes(
+        orjson.dumps(dashboard_data, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY, default=str)
+    )
     
     print(f"Generated dashboard data with {len(dashboard_data.get('recent_activities', []))} recent activities")
 